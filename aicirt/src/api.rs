@@ -1,6 +1,6 @@
 use crate::{shm::ShmAllocator, HashMap};
 use aici_abi::{ProcessResultOffset, StorageCmd, TokenId};
-use anyhow::{anyhow, Result};
+use anyhow::{anyhow, ensure, Result};
 use serde::{Deserialize, Serialize};
 use serde_json::Value;
 
@@ -22,6 +22,75 @@ pub struct AiciMidProcessReq {
     pub freed: Vec<ModuleInstId>,
 }
 
+/// Magic prefix of binary mid_process frames; JSON commands always start with '{'.
+pub const MID_PROCESS_BIN_MAGIC: &[u8; 4] = b"\0MP1";
+
+impl AiciMidProcessReq {
+    /// Decode binary mid_process frame, as sent by pyaici's MessageChannel.send_step().
+    /// All fields are little-endian u32:
+    ///   magic, n_freed, n_ops, n_tokens,
+    ///   freed[n_freed],
+    ///   id[n_ops], clone_id[n_ops], clone_idx[n_ops], backtrack[n_ops], num_tokens[n_ops],
+    ///   tokens[n_tokens]
+    /// clone_id and clone_idx are u32::MAX when not set; req_id is never set
+    /// (ops with req_id are sent as JSON).
+    pub fn from_bin(msg: &[u8]) -> Result<Self> {
+        ensure!(
+            msg.len() >= 16 && msg.len() % 4 == 0 && msg.starts_with(MID_PROCESS_BIN_MAGIC),
+            "invalid binary mid_process frame"
+        );
+        let words = msg[4..]
+            .chunks_exact(4)
+            .map(|c| u32::from_le_bytes(c.try_into().unwrap()))
+            .collect::<Vec<_>>();
+        let n_freed = words[0] as usize;
+        let n_ops = words[1] as usize;
+        let n_tokens = words[2] as usize;
+        ensure!(
+            words.len() == 3 + n_freed + 5 * n_ops + n_tokens,
+            "binary mid_process frame size mismatch"
+        );
+
+        let freed = words[3..3 + n_freed]
+            .iter()
+            .map(|&id| id as ModuleInstId)
+            .collect();
+        let cols = &words[3 + n_freed..];
+        let col = |i: usize| &cols[i * n_ops..(i + 1) * n_ops];
+        let opt = |v: u32| {
+            if v == u32::MAX {
+                None
+            } else {
+                Some(v as usize)
+            }
+        };
+        let (ids, clone_ids, clone_idxs, backtracks, num_tokens) =
+            (col(0), col(1), col(2), col(3), col(4));
+        let mut tokens = &cols[5 * n_ops..];
+
+        let mut ops = Vec::with_capacity(n_ops);
+        for i in 0..n_ops {
+            let n = num_tokens[i] as usize;
+            ensure!(n <= tokens.len(), "binary mid_process frame token overflow");
+            ops.push(AiciMidOp {
+                id: ids[i] as ModuleInstId,
+                clone_id: opt(clone_ids[i]),
+                clone_idx: opt(clone_idxs[i]),
+                req_id: None,
+                backtrack: backtracks[i],
+                tokens: tokens[..n].to_vec(),
+            });
+            tokens = &tokens[n..];
+        }
+        ensure!(
+            tokens.is_empty(),
+            "binary mid_process frame has trailing tokens"
+        );
+
+        Ok(AiciMidProcessReq { ops, freed })
+    }
+}
+
 #[derive(Serialize, Deserialize)]
 pub struct AiciMidProcessResp {
     pub seqs: HashMap<ModuleInstId, SequenceResult<ProcessResultOffset>>,
@@ -901,6 +901,12 @@ impl Exec for Stepper {
             _ => return Err(anyhow!("bad op")),
         }
     }
+
+    fn exec_bin(&mut self, msg: &[u8]) -> Result<Value> {
+        Ok(serde_json::to_value(
+            &self.aici_mid_process(AiciMidProcessReq::from_bin(msg)?)?,
+        )?)
+    }
 }
 
 impl Exec for ModuleRegistry {
@@ -916,10 +922,47 @@ impl Exec for ModuleRegistry {
     }
 }
 
+fn wrap_exec_result(val: Result<Value>, msg: &[u8]) -> Value {
+    match val {
+        Ok(v) => {
+            log::trace!(
+                "dispatch ok: {}",
+                limit_str(&serde_json::to_string(&v).unwrap(), 200)
+            );
+            json!({
+                "type": "ok",
+                "data": v
+            })
+        }
+        Err(err) => {
+            let errmsg = UserError::maybe_stacktrace(&err);
+            log::warn!("dispatch error: {}", errmsg);
+            log::info!(
+                "for data: {}",
+                String::from_utf8_lossy(&msg[0..std::cmp::min(100, msg.len())])
+            );
+            json!({
+                "type": "error",
+                "error": errmsg,
+                "is_user_error": UserError::is_self(&err)
+            })
+        }
+    }
+}
+
 trait Exec {
     fn exec(&mut self, json: Value, auth: AuthInfo) -> Result<Value>;
 
+    /// Binary (non-JSON) commands; currently only mid_process.
+    fn exec_bin(&mut self, _msg: &[u8]) -> Result<Value> {
+        Err(anyhow!("binary commands not supported"))
+    }
+
     fn exec_wrapped(&mut self, msg: &[u8]) -> Value {
+        if msg.starts_with(MID_PROCESS_BIN_MAGIC) {
+            log::trace!("dispatch: binary mid_process");
+            return wrap_exec_result(self.exec_bin(msg), msg);
+        }
         match serde_json::from_slice::<Value>(msg) {
             Ok(json) => {
                 let rid = json["$rid"].as_str().map(|v| v.to_string());
@@ -940,31 +983,7 @@ trait Exec {
                         }
                     }
                 };
-                let mut resp = match val {
-                    Ok(v) => {
-                        log::trace!(
-                            "dispatch ok: {}",
-                            limit_str(&serde_json::to_string(&v).unwrap(), 200)
-                        );
-                        json!({
-                            "type": "ok",
-                            "data": v
-                        })
-                    }
-                    Err(err) => {
-                        let errmsg = UserError::maybe_stacktrace(&err);
-                        log::warn!("dispatch error: {}", errmsg);
-                        log::info!(
-                            "for data: {}",
-                            String::from_utf8_lossy(&msg[0..std::cmp::min(100, msg.len())])
-                        );
-                        json!({
-                            "type": "error",
-                            "error": errmsg,
-                            "is_user_error": UserError::is_self(&err)
-                        })
-                    }
-                };
+                let mut resp = wrap_exec_result(val, msg);
                 match rid {
                     Some(rid) => {
                         resp["$rid"] = Value::String(rid);
@@ -1,8 +1,9 @@
 import pyaici.rest
 import pyaici.cli
 import base64
-import ujson as json
-import binascii
+import hashlib
+import os
+import orjson
 
 
 import guidance
@@ -18,9 +19,32 @@ from guidance import (
 )
 
 
+def grammar_b64(grm) -> str:
+    """
+    Serialize and base64-encode the grammar, caching the result on disk.
+    """
+    # grm is fully determined by this script and the guidance version, so key on those;
+    # repr(grm) would not do, as it leaves out capture names, temperatures etc.
+    with open(__file__, "rb") as f:
+        key_src = guidance.__version__.encode() + b"\n" + f.read()
+    key = hashlib.blake2b(key_src, digest_size=16).hexdigest()
+    path = os.path.expanduser(f"~/.cache/aici/grm-{key}.b64")
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read()
+    b64 = base64.b64encode(grm.serialize()).decode("utf-8")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temp file and rename, so an interrupted run can't leave a truncated entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(b64)
+    os.replace(tmp_path, path)
+    return b64
+
+
 @guidance(stateless=True)
 def number(lm):
-    n = one_or_more(select(["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]))
+    n = one_or_more(byte_range(b"0", b"9"))
     return lm + select(["-" + n, n])
 
 
@@ -48,22 +72,20 @@ def stmt(lm):
 
 @guidance(stateless=True)
 def operator(lm):
-    return lm + select(["+", "*", "**", "/", "-"])
+    return lm + select(["+", "-", "/", "*" + optional("*")])
+
+
+@guidance(stateless=True)
+def primary(lm):
+    return lm + select([identifier(), "(" + expression() + ")"])
 
 
 @guidance(stateless=True)
 def expression(lm):
-    return lm + select(
-        [
-            identifier(),
-            expression()
-            + zero_or_more(" ")
-            + operator()
-            + zero_or_more(" ")
-            + expression(),
-            "(" + expression() + ")",
-        ]
-    )
+    # primary (op primary)* - same language as the left-recursive
+    # expr op expr form, but without the ambiguity
+    ws = zero_or_more(" ")
+    return lm + primary() + zero_or_more(ws + operator() + ws + primary())
 
 
 def main():
@@ -165,7 +187,7 @@ def main():
     # with open(__file__) as f:
     #     script = f.read()
     # grm = "```python\n" + substring(script[0:1400])
-    b64 = base64.b64encode(grm.serialize()).decode("utf-8")
+    b64 = grammar_b64(grm)
     print(len(b64))
     mod_id = pyaici.cli.build_rust(".")
     if "127.0.0.1" in pyaici.rest.base_url:
@@ -174,7 +196,7 @@ def main():
     res = pyaici.rest.run_controller(
         prompt=prompt,
         controller=mod_id,
-        controller_arg=json.dumps({"guidance_b64": b64}),
+        controller_arg=orjson.dumps({"guidance_b64": b64}).decode(),
         temperature=0.0,
         max_tokens=100,
     )
@@ -184,14 +206,15 @@ def main():
     print("Storage:", res["storage"])
     print()
 
-    text = b""
-    captures = {}
-    for j in res["json_out"][0]:
-        if j["object"] == "text":
-            text += binascii.unhexlify(j["hex"])
-        elif j["object"] == "capture":
-            captures[j["name"]] = binascii.unhexlify(j["hex"]).decode("utf-8", errors="replace")
-    print("Captures:", json.dumps(captures, indent=2))
+    evs = res["json_out"][0]
+    text = bytes.fromhex("".join([j["hex"] for j in evs if j["object"] == "text"]))
+    # later captures with the same name win, so only decode the last one
+    capture_hex = {j["name"]: j["hex"] for j in evs if j["object"] == "capture"}
+    captures = {
+        name: bytes.fromhex(h).decode("utf-8", errors="replace")
+        for name, h in capture_hex.items()
+    }
+    print("Captures:", orjson.dumps(captures, option=orjson.OPT_INDENT_2).decode())
     print("Final text:\n", text.decode("utf-8", errors="replace"))
     print()
 
@@ -1,8 +1,7 @@
 import pyaici.rest
 import pyaici.cli
 import base64
-import ujson as json
-import binascii
+import orjson
 import os
 
 import guidance
@@ -239,7 +238,7 @@ def main():
     # with open("tmp/long_json_grammar_req.json", "r") as f:
     #     # with open("tmp/email_regex_grammar.json", "r") as f:
     #     max_tokens = 1000
-    #     serialized = json.load(f)
+    #     serialized = orjson.loads(f.read())
 
     x_serialized = {
         "grammars": [
@@ -262,12 +261,12 @@ def main():
     serialized["test_trace"] = True
     llguidance_json = {"grammar": serialized}
 
-    llguidance_arg = json.dumps(llguidance_json, indent=1)
+    llguidance_arg = orjson.dumps(llguidance_json, option=orjson.OPT_INDENT_2).decode()
     # save llguidance_arg to file
     with open("tmp/llguidance_arg.json", "w") as f:
         f.write(llguidance_arg)
     print("JSON size:", len(llguidance_arg), "saved to tmp/llguidance_arg.json")
-    # print(json.dumps(llguidance_json, indent=2))
+    # print(orjson.dumps(llguidance_json, option=orjson.OPT_INDENT_2).decode())
 
     # with open("tmp/long_json_grammar_req.json", "r") as f:
     #     llguidance_arg = f.read()
@@ -299,16 +298,15 @@ def main():
 
     testcase_from_logs(res["logs"][0])
 
-    text = b""
-    captures = {}
-    for j in res["json_out"][0]:
-        if j["object"] == "text":
-            text += binascii.unhexlify(j["hex"])
-        elif j["object"] == "capture":
-            captures[j["name"]] = binascii.unhexlify(j["hex"]).decode(
-                "utf-8", errors="replace"
-            )
-    print("Captures:", json.dumps(captures, indent=2))
+    evs = res["json_out"][0]
+    text = bytes.fromhex("".join([j["hex"] for j in evs if j["object"] == "text"]))
+    # later captures with the same name win, so only decode the last one
+    capture_hex = {j["name"]: j["hex"] for j in evs if j["object"] == "capture"}
+    captures = {
+        name: bytes.fromhex(h).decode("utf-8", errors="replace")
+        for name, h in capture_hex.items()
+    }
+    print("Captures:", orjson.dumps(captures, option=orjson.OPT_INDENT_2).decode())
     print("Final text:\n", text.decode("utf-8", errors="replace"))
     print()
 
@@ -320,7 +318,7 @@ def testcase_from_logs(logs: str):
     prompt = None
     for line in logs.split("\n"):
         if line.startswith("TEST: "):
-            obj = json.loads(line[6:])
+            obj = orjson.loads(line[6:])
             if prompt is None:
                 prompt = obj["res_prompt"]
                 continue
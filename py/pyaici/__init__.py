@@ -36,6 +36,8 @@ def runner_from_cli(args, dtype: str = 'f32'):
         rtargs=args.aici_rtarg,
         pref=args.aici_shm_prefix,
         dtype=dtype,
+        futex=args.aici_futex,
+        overlap_recv=args.aici_overlap_recv,
     )
     return aici
 
@@ -53,6 +55,16 @@ def add_cli_args(parser: argparse.ArgumentParser, single=False):
         default="/aici0-",
         help="prefix for shared memory communication channels",
     )
+    parser.add_argument(
+        "--aici-futex",
+        action="store_true",
+        help="use futexes instead of POSIX semaphores for aicirt communication (Linux x86_64 only)",
+    )
+    parser.add_argument(
+        "--aici-overlap-recv",
+        action="store_true",
+        help="receive aicirt mid_process responses on a background thread, overlapping the forward pass",
+    )
     parser.add_argument(
         "--aici-tokenizer",
         type=str,
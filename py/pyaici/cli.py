@@ -1,5 +1,5 @@
 import subprocess
-import json
+import orjson
 import sys
 import os
 import argparse
@@ -15,14 +15,7 @@ def cli_error(msg: str):
     sys.exit(1)
 
 
-def build_rust(folder: str, features: List[str] = []):
-    bin_file = ""
-    spl = folder.split("::")
-    if len(spl) > 1:
-        folder = spl[0]
-        bin_file = spl[1]
-    if not os.path.exists(folder + "/Cargo.toml"):
-        cli_error(f"{folder}/Cargo.toml not found")
+def wasm_target_path(folder: str, bin_file: str, triple: str) -> str:
     r = subprocess.run(
         [
             "cargo",
@@ -35,35 +28,46 @@ def build_rust(folder: str, features: List[str] = []):
         stdout=-1,
         check=True,
     )
-    info = json.loads(r.stdout)
+    info = orjson.loads(r.stdout)
     if len(info["workspace_default_members"]) != 1:
         cli_error("please run from project, not workspace, folder")
     pkg_id = info["workspace_default_members"][0]
-    pkg = [pkg for pkg in info["packages"] if pkg["id"] == pkg_id][0]
+    pkg = next(pkg for pkg in info["packages"] if pkg["id"] == pkg_id)
 
-    bins = [trg for trg in pkg["targets"] if trg["kind"] == ["bin"]]
+    bins = {
+        trg["name"]: trg
+        for trg in pkg["targets"] if trg["kind"] == ["bin"]
+    }
     if len(bins) == 0:
         cli_error("no bin targets found")
-    bins_str = ", ".join([folder + "::" + trg["name"] for trg in bins])
+    bins_str = ", ".join([folder + "::" + name for name in bins])
     if bin_file:
-        if len([trg for trg in bins if trg["name"] == bin_file]) == 0:
+        if bin_file not in bins:
             cli_error(f"{bin_file} not found; try one of {bins_str}")
     else:
         if len(bins) > 1:
             cli_error("more than one bin target found; use one of: " +
                       bins_str)
-        bin_file = bins[0]["name"]
+        bin_file = next(iter(bins))
     print(f'will build {bin_file} from {pkg["manifest_path"]}')
 
+    return (info["target_directory"] + "/" + triple + "/release/" +
+            bin_file + ".wasm")
+
+
+def build_rust(folder: str, features: List[str] = []):
+    bin_file = ""
+    spl = folder.split("::")
+    if len(spl) > 1:
+        folder = spl[0]
+        bin_file = spl[1]
+    if not os.path.exists(folder + "/Cargo.toml"):
+        cli_error(f"{folder}/Cargo.toml not found")
+
     triple = "wasm32-wasi"
-    trg_path = (info["target_directory"] + "/" + triple + "/release/" +
-                bin_file + ".wasm")
-    # remove file first, so we're sure it's rebuilt
-    try:
-        os.unlink(trg_path)
-    except:
-        pass
-    r = subprocess.run(
+    # start the build right away, so it runs in parallel with 'cargo metadata';
+    # it builds all bin targets, so it doesn't need anything from the metadata
+    build_proc = subprocess.Popen(
         [
             "cargo",
             "build",
@@ -73,11 +77,16 @@ def build_rust(folder: str, features: List[str] = []):
         ] + (["--features", ",".join(features)] if features else []),
         cwd=folder,
     )
-    if r.returncode != 0:
+    try:
+        trg_path = wasm_target_path(folder, bin_file, triple)
+    except BaseException:
+        build_proc.terminate()
+        build_proc.wait()
+        raise
+    if build_proc.wait() != 0:
         sys.exit(1)
-    bb = open(trg_path, "rb").read()
     M = 1024 * 1024
-    print(f"built: {trg_path}, {len(bb)/M:.3} MiB")
+    print(f"built: {trg_path}, {os.path.getsize(trg_path)/M:.3} MiB")
     return rest.upload_module(trg_path)
 
 
@@ -112,8 +121,8 @@ def run_ctrl(
             print("[Response] " + text + "\n")
     os.makedirs("tmp", exist_ok=True)
     path = "tmp/response.json"
-    with open(path, "w") as f:
-        json.dump(res, f, indent=1)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(res, option=orjson.OPT_INDENT_2))
     print(f"response saved to {path}")
     print("Usage:", res["usage"])
     print("Timing:", res["timing"])
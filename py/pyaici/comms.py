@@ -4,14 +4,17 @@ import mmap
 import os
 import struct
 import subprocess
-import ujson as json
-
-# import json as json
+import orjson
 import base64
 import time
 import asyncio
 import concurrent.futures
+import ctypes
+import platform
+import sys
+from array import array
 import threading
+import queue
 import atexit
 import signal
 
@@ -21,6 +24,15 @@ from typing import List, Union, Dict, Any, Optional, Tuple, Set
 # (Linux has 255)
 DEFAULT_SHM_PREF = "/aici0-"
 
+# length prefix of every MessageChannel message
+_LEN = struct.Struct("<I")
+
+# Binary mid_process frame; see AiciMidProcessReq::from_bin() in aicirt/src/api.rs
+MID_PROCESS_BIN_MAGIC = b"\0MP1"
+_MID_HEADER = struct.Struct("<4sIII")
+# clone_id/clone_idx value for "not set" in the binary frame
+_NO_ID = 0xFFFFFFFF
+
 
 class BenchTimer:
 
@@ -45,8 +57,8 @@ class BenchTimer:
             self.num = 0
 
 
-def mkshm(name, size):
-    shm_name = name + "-shm"
+def mkshm(name, size, suffix="-shm"):
+    shm_name = name + suffix
     # clean up just in case
     try:
         posix_ipc.unlink_shared_memory(shm_name)
@@ -92,12 +104,39 @@ class MessageChannel:
 
     def send_bytes(self, msg_bytes):
         self.write_sem.acquire()
-        self.map_file[0:4] = struct.pack("<I", len(msg_bytes))
+        _LEN.pack_into(self.map_file, 0, len(msg_bytes))
         self.map_file[4:4 + len(msg_bytes)] = msg_bytes
         self.read_sem.release()
 
+    def send_parts(self, parts: list):
+        """
+        Send a single message made of concatenated buffers, without joining them first.
+        """
+        self.write_sem.acquire()
+        off = 4
+        for part in parts:
+            part = memoryview(part).cast("B")
+            self.map_file[off:off + len(part)] = part
+            off += len(part)
+        _LEN.pack_into(self.map_file, 0, off - 4)
+        self.read_sem.release()
+
     def send_json(self, obj):
-        self.send_bytes(json.dumps(obj).encode())
+        self.send_bytes(orjson.dumps(obj))
+
+    def send_step(self, freed: array, cols: List[array], tokens: array):
+        """
+        Send a binary mid_process frame.
+
+        Args:
+            freed (array): Freed sequence IDs ('I' array).
+            cols (list): 'I' arrays with id, clone_id, clone_idx, backtrack and number of tokens
+                for each op; clone_id/clone_idx are 0xFFFFFFFF when not set.
+            tokens (array): Concatenated tokens of all ops ('I' array).
+        """
+        header = _MID_HEADER.pack(MID_PROCESS_BIN_MAGIC, len(freed),
+                                  len(cols[0]), len(tokens))
+        self.send_parts([header, freed, *cols, tokens])
 
     def _acquire_read(self):
         if not self.busy_mode:
@@ -112,20 +151,28 @@ class MessageChannel:
                     num += 1
                     continue
 
-    def recv(self):
+    def _recv_with(self, parse):
         if self.track:
             self.track = False
             with self.aq_timer:
                 self._acquire_read()
         else:
             self._acquire_read()
-        msg_len = struct.unpack("<I", self.map_file[0:4])[0]
-        msg = self.map_file[4:4 + msg_len]
-        self.write_sem.release()
-        return msg
+        msg_len = _LEN.unpack_from(self.map_file, 0)[0]
+        # parse straight out of the shared memory; this has to happen before
+        # the write semaphore is released, as the writer can then overwrite it
+        msg = memoryview(self.map_file)[4:4 + msg_len]
+        try:
+            return parse(msg)
+        finally:
+            msg.release()
+            self.write_sem.release()
+
+    def recv(self):
+        return self._recv_with(bytes)
 
     def recv_json(self):
-        return json.loads(self.recv())
+        return self._recv_with(orjson.loads)
 
     def close(self):
         self.map_file.close()
@@ -134,6 +181,92 @@ class MessageChannel:
         # self.read_sem.unlink()
 
 
+_FUTEX_WAIT = 0
+_FUTEX_WAKE = 1
+_libc = None
+
+
+def _futex(addr: int, op: int, val: int):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    # SYS_futex on x86_64; errors (EAGAIN, EINTR) just make the caller re-check the value
+    _libc.syscall(ctypes.c_long(202), ctypes.c_void_p(addr), ctypes.c_long(op),
+                  ctypes.c_long(val), None)
+
+
+class FutexChannel(MessageChannel):
+    """
+    Client side of aicirt's futex channel (futexshm.rs; aicirt started with --futex).
+
+    The shared memory is split in halves; each starts with a u32 length,
+    which is also the futex word, followed by the message.
+    We write into the first half, aicirt writes into the second one.
+    Length of 0 (or 0xFFFFFFFF, while aicirt is writing) means no message.
+    """
+
+    def __init__(self, name, size):
+        if sys.platform != "linux" or platform.machine() != "x86_64":
+            # we rely on x86 store ordering for the message being visible before its length
+            raise ValueError("futex channel is only supported on Linux x86_64")
+        self.size = size
+        self.map_file = mkshm(name, size, suffix="")
+        self.busy_mode = False
+        self.wr_off = 0
+        self.rd_off = size // 2
+        self.max_msg_size = size // 2 - 16
+        self.wr_word = ctypes.c_uint32.from_buffer(self.map_file, self.wr_off)
+        self.rd_word = ctypes.c_uint32.from_buffer(self.map_file, self.rd_off)
+        self.aq_timer = BenchTimer("aq_" + name)
+        self.track = False
+
+    def send_bytes(self, msg_bytes):
+        self.send_parts([msg_bytes])
+
+    def send_parts(self, parts: list):
+        parts = [memoryview(part).cast("B") for part in parts]
+        size = sum(len(part) for part in parts)
+        if size > self.max_msg_size:
+            raise ValueError(f"msg too large; {size} > {self.max_msg_size}")
+        # the previous message has to be picked up first; aicirt doesn't wake us for that
+        while self.wr_word.value != 0:
+            os.sched_yield()
+        off = self.wr_off + 4
+        for part in parts:
+            self.map_file[off:off + len(part)] = part
+            off += len(part)
+        self.wr_word.value = size
+        _futex(ctypes.addressof(self.wr_word), _FUTEX_WAKE, 0x7FFFFFFF)
+
+    def _acquire_read(self) -> int:
+        while True:
+            val = self.rd_word.value
+            if val != 0 and val != 0xFFFFFFFF:
+                return val
+            if not self.busy_mode:
+                _futex(ctypes.addressof(self.rd_word), _FUTEX_WAIT, val)
+
+    def _recv_with(self, parse):
+        if self.track:
+            self.track = False
+            with self.aq_timer:
+                msg_len = self._acquire_read()
+        else:
+            msg_len = self._acquire_read()
+        off = self.rd_off + 4
+        msg = memoryview(self.map_file)[off:off + msg_len]
+        try:
+            return parse(msg)
+        finally:
+            msg.release()
+            self.rd_word.value = 0
+
+    def close(self):
+        del self.wr_word
+        del self.rd_word
+        self.map_file.close()
+
+
 M = 1024 * 1024
 
 
@@ -162,14 +295,16 @@ class CmdChannel:
                  pref: str,
                  suff: str,
                  trace_file,
-                 bad_response=bad_response) -> None:
+                 bad_response=bad_response,
+                 futex=False) -> None:
         self.pending_reqs: Dict[str, PendingRequest] = {}
         self.executor = None
         self.suff = suff
         self.cmd_pending = False
         self.last_cmd = {}
-        self.cmd_ch = MessageChannel(pref + "cmd" + suff, json_size * M)
-        self.resp_ch = MessageChannel(pref + "resp" + suff, json_size * M)
+        ch_cls = FutexChannel if futex else MessageChannel
+        self.cmd_ch = ch_cls(pref + "cmd" + suff, json_size * M)
+        self.resp_ch = ch_cls(pref + "resp" + suff, json_size * M)
         self.trace_file = trace_file
         self.bad_response = bad_response
 
@@ -180,6 +315,13 @@ class CmdChannel:
         self.cmd_pending = True
         self.cmd_ch.send_json(data)
 
+    def send_step(self, freed: array, cols: List[array], tokens: array):
+        assert self.executor is None
+        assert not self.cmd_pending
+        self.last_cmd = {"op": "mid_process", "binary": True}
+        self.cmd_pending = True
+        self.cmd_ch.send_step(freed, cols, tokens)
+
     async def exec_async(self, op: str, data={}, auth_info=None):
         loop = asyncio.get_running_loop()
 
@@ -221,7 +363,7 @@ class CmdChannel:
             if resp["type"] == "error" and "error" in resp:
                 info = resp["error"][0:20000]
             else:
-                info = json.dumps(resp)[0:20000]
+                info = orjson.dumps(resp).decode()[0:20000]
             self.bad_response(op, info)
             assert False
 
@@ -232,12 +374,12 @@ class CmdChannel:
             return
 
         self.trace_file.write(
-            json.dumps({
+            orjson.dumps({
                 "timestamp": time.time() * 1000,
                 "suff": self.suff,
                 "cmd": cmd,
                 "resp": resp,
-            }) + "\n")
+            }).decode() + "\n")
         self.trace_file.flush()
 
     def exec(self, op: str, data={}):
@@ -253,7 +395,7 @@ class CmdChannel:
         self._trace_resp(self.last_cmd, resp)
         if resp["type"] != "ok":
             raise ChildProcessError(
-                f"Bad response ({ctx}): {json.dumps(resp)[0:1000]}")
+                f"Bad response ({ctx}): {orjson.dumps(resp).decode()[0:1000]}")
         return resp
 
 
@@ -338,6 +480,8 @@ class AiciRunner:
         trace_file=None,
         rtargs=[],
         dtype="f32",
+        overlap_recv=False,
+        futex=False,
     ) -> None:
         """
         Start a new aicirt process and initialize comms channels.
@@ -350,6 +494,9 @@ class AiciRunner:
             pref (str, optional): Prefix for the shared memory and message channels. Defaults to "/aici0-".
             trace_file (str, optional): If set, save a trace of the interaction to this file.
             rtagrs (list, optional): Extra arguments to pass to the aicirt process.
+            overlap_recv (bool, optional): Receive and parse mid_process responses on a background thread,
+                overlapping it with the model forward pass. Disables busy-waiting on the response channel.
+            futex (bool, optional): Use futex-based channels instead of POSIX semaphores (Linux x86_64 only).
         """
 
         self.vocab_size = -1
@@ -370,9 +517,16 @@ class AiciRunner:
             self.trace_file = None
 
         self.logit_pending = False
+        self.overlap_recv = overlap_recv
+        # daemon thread running _expect_mid() when overlap_recv is set;
+        # None on the request queue makes it exit
+        self.mid_thread: Optional[threading.Thread] = None
+        self.mid_requests: queue.Queue = queue.Queue(1)
+        self.mid_results: queue.Queue = queue.Queue(1)
+        self.mid_recv_pending = False
 
         self.pending_req_ids: Dict[int, str] = {}
-        self.mid_ops = []
+        self._reset_mid_ops()
         self.freed_seq_ids = []
         self.pending_instantiate_results = {}
         self.pending_generated_tokens: Dict[int, Tuple[List[int], int]] = {}
@@ -380,14 +534,20 @@ class AiciRunner:
         self.cmd = CmdChannel(pref=pref,
                               suff="",
                               json_size=json_size,
-                              trace_file=self.trace_file)
-        self.cmd.resp_ch.busy_mode = True
+                              trace_file=self.trace_file,
+                              futex=futex)
+        # busy-waiting on a background thread would starve the main one of the GIL
+        self.cmd.resp_ch.busy_mode = not overlap_recv
         self.side_cmd = CmdChannel(pref=pref,
                                    suff="-side",
                                    json_size=json_size,
-                                   trace_file=self.trace_file)
+                                   trace_file=self.trace_file,
+                                   futex=futex)
 
         self.bin_shm = mkshm(pref + "bin", bin_size * M)
+        # flat views over bin_shm, created on first use by recv_logit_bias_*()
+        self._bin_numpy = None
+        self._bin_torch = None
 
         args = [
             rtpath,
@@ -400,6 +560,8 @@ class AiciRunner:
         ]
         if fork_supported:
             args.append("--cap-fork")
+        if futex:
+            args.append("--futex")
         args += rtargs
 
         print("running: ", args)
@@ -454,7 +616,7 @@ class AiciRunner:
     def replay(self, prev_trace: str):
         with open(prev_trace) as f:
             for line in f:
-                obj = json.loads(line)
+                obj = orjson.loads(line)
                 ch = self.cmd
                 if obj["suff"] == "-side":
                     ch = self.side_cmd
@@ -517,7 +679,7 @@ class AiciRunner:
         return "data: [DONE]\n\n"
 
     def data_line(self, data: dict):
-        return f"data: {json.dumps(data)}\n\n"
+        return f"data: {orjson.dumps(data).decode()}\n\n"
 
     async def instantiate_async(
         self,
@@ -680,41 +842,80 @@ class AiciRunner:
         for seq_id in self.pending_logs():
             self.print_logs_for(seq_id)
 
+    def _reset_mid_ops(self):
+        # pending mid_process ops, stored column-wise, in the layout of the binary frame:
+        # id, clone_id, clone_idx, backtrack, num_tokens
+        self.mid_cols = [array("I") for _ in range(5)]
+        self.mid_tokens = array("I")
+        # req_id is only set on the first step of a request; indexed by op position
+        self.mid_req_ids: Dict[int, str] = {}
+
+    def _mid_ops_json(self) -> List[dict]:
+        ids, clone_ids, clone_idxs, backtracks, num_tokens = self.mid_cols
+        ops = []
+        off = 0
+        for i in range(len(ids)):
+            n = num_tokens[i]
+            obj: Dict[str, Any] = {
+                "id": ids[i],
+                "backtrack": backtracks[i],
+                "tokens": self.mid_tokens[off:off + n].tolist(),
+            }
+            off += n
+            if i in self.mid_req_ids:
+                obj["req_id"] = self.mid_req_ids[i]
+            if clone_ids[i] != _NO_ID:
+                obj["clone_id"] = clone_ids[i]
+                obj["clone_idx"] = clone_idxs[i]
+            ops.append(obj)
+        return ops
+
     def add_mid(self,
                 id: int,
                 clone_id: Optional[int] = None,
                 clone_idx: Optional[int] = None):
         assert not self.logit_pending
-        tokens, backtrack = self.pending_generated_tokens.get(id, ([], 0))
-        if id in self.pending_generated_tokens:
-            del self.pending_generated_tokens[id]
-        obj: Dict[str, Any] = {
-            "id": id,
-            "backtrack": backtrack,
-            "tokens": tokens,
-        }
+        tokens, backtrack = self.pending_generated_tokens.pop(id, ([], 0))
+        ids, clone_ids, clone_idxs, backtracks, num_tokens = self.mid_cols
         if id in self.pending_req_ids:
-            obj["req_id"] = self.pending_req_ids[id]
-            del self.pending_req_ids[id]
-        if clone_id is not None:
+            self.mid_req_ids[len(ids)] = self.pending_req_ids.pop(id)
+        if clone_id is None:
+            clone_id = clone_idx = _NO_ID
+        else:
             assert clone_idx is not None
-            obj["clone_id"] = clone_id
-            obj["clone_idx"] = clone_idx
-        self.mid_ops.append(obj)
+        ids.append(id)
+        clone_ids.append(clone_id)
+        clone_idxs.append(clone_idx)
+        backtracks.append(backtrack)
+        num_tokens.append(len(tokens))
+        self.mid_tokens.extend(tokens)
 
     def needs_exec_mid(self):
-        return len(self.mid_ops) > 0
+        return len(self.mid_cols[0]) > 0
 
     def exec_mid(self):
         assert not self.logit_pending
-        cmd = {
-            "op": "mid_process",
-            "ops": self.mid_ops,
-            "freed": self.freed_seq_ids,
-        }
-        self.cmd.send(cmd)
+        # new requests carry string req_id, which only JSON can express;
+        # also use JSON when tracing, so the trace can be replayed
+        if self.trace_file or self.mid_req_ids:
+            cmd = {
+                "op": "mid_process",
+                "ops": self._mid_ops_json(),
+                "freed": self.freed_seq_ids,
+            }
+            self.cmd.send(cmd)
+        else:
+            self.cmd.send_step(array("I", self.freed_seq_ids), self.mid_cols,
+                               self.mid_tokens)
         self.freed_seq_ids = []
         self.logit_pending = True
+        if self.overlap_recv:
+            if self.mid_thread is None:
+                self.mid_thread = threading.Thread(target=self._mid_reader,
+                                                   daemon=True)
+                self.mid_thread.start()
+            self.mid_requests.put(True)
+            self.mid_recv_pending = True
 
     def flush_logit_bias(self):
         """
@@ -723,7 +924,10 @@ class AiciRunner:
         if self.logit_pending:
             print("Warning: unflushed AICI logit bias")
             self.logit_pending = False
-            self.cmd.expect("flush")
+            if self.mid_recv_pending:
+                self._wait_mid()
+            else:
+                self.cmd.expect("flush")
 
     def recv_logit_bias_numpy(self):
         import numpy
@@ -734,11 +938,12 @@ class AiciRunner:
         data = self._recv_logit_bias()
         vocab_size = data["mask_num_elts"]
         num_masks = data["num_masks"]
-        arr = numpy.frombuffer(self.bin_shm,
-                               dtype=dtype_map[self.dtype],
-                               offset=data["first_mask_byte_offset"],
-                               count=vocab_size * num_masks).reshape(
-                                   [num_masks, vocab_size])
+        if self._bin_numpy is None:
+            self._bin_numpy = numpy.frombuffer(self.bin_shm,
+                                               dtype=dtype_map[self.dtype])
+        off = data["first_mask_byte_offset"] // self._bin_numpy.itemsize
+        arr = self._bin_numpy[off:off + vocab_size * num_masks].reshape(
+            [num_masks, vocab_size])
         return self.last_resp, arr
 
     def recv_logit_bias_torch(self):
@@ -751,35 +956,64 @@ class AiciRunner:
         data = self._recv_logit_bias()
         vocab_size = data["mask_num_elts"]
         num_masks = data["num_masks"]
-        arr = torch.frombuffer(self.bin_shm,
-                               dtype=dtype_map[self.dtype],
-                               offset=data["first_mask_byte_offset"],
-                               count=vocab_size * num_masks).reshape(
-                                   [num_masks, vocab_size])
+        if self._bin_torch is None:
+            self._bin_torch = torch.frombuffer(self.bin_shm,
+                                               dtype=dtype_map[self.dtype])
+        off = data["first_mask_byte_offset"] // self._bin_torch.element_size()
+        arr = self._bin_torch[off:off + vocab_size * num_masks].reshape(
+            [num_masks, vocab_size])
         return self.last_resp, arr
 
+    def _mid_reader(self):
+        while self.mid_requests.get() is not None:
+            try:
+                self.mid_results.put((self._expect_mid(), None))
+            except BaseException as e:
+                self.mid_results.put((None, e))
+
+    def _wait_mid(self) -> Tuple[dict, Dict[int, MidResult]]:
+        res, err = self.mid_results.get()
+        self.mid_recv_pending = False
+        if err is not None:
+            raise err
+        return res
+
+    def _expect_mid(self) -> Tuple[dict, Dict[int, MidResult]]:
+        data = self.cmd.expect("recv")["data"]
+        last_resp = {
+            int(id): MidResult.from_json(seq_res)
+            for id, seq_res in data["seqs"].items()
+        }
+        return data, last_resp
+
     def _recv_logit_bias(self):
         """
         Retrieve the logit bias for the step last executed with `step_finish()`.
         """
         assert self.logit_pending
         self.logit_pending = False
-        data = self.cmd.expect("recv")["data"]
-        seqs: dict = data["seqs"]
-        self._add_logs(seqs)
-        last_resp: dict[int, MidResult] = {}
-        for id, seq_res in seqs.items():
-            r = MidResult.from_json(seq_res)
+        if self.mid_recv_pending:
+            data, last_resp = self._wait_mid()
+        else:
+            data, last_resp = self._expect_mid()
+        self._add_logs(data["seqs"])
+        for id, r in last_resp.items():
             if r.error or not r.branches:
-                self.seqs_to_stop.add(int(id))
-            last_resp[int(id)] = r
+                self.seqs_to_stop.add(id)
         self.last_resp = last_resp
-        self.mid_ops = []
+        self._reset_mid_ops()
         return data
 
     def stop(self):
         """
         Stops the aicirt process and waits for it to exit.
         """
+        # the background reader owns the channel until the pending response arrives
+        if self.mid_recv_pending:
+            self._wait_mid()
+        if self.mid_thread is not None:
+            self.mid_requests.put(None)
+            self.mid_thread.join()
+            self.mid_thread = None
         self.cmd.send({"op": "stop"})
         self.proc.wait()
@@ -10,6 +10,7 @@ setup(
         ]
     },
     install_requires=[
-        'requests'
+        'requests',
+        'orjson',
     ],
 )